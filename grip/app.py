@@ -16,7 +16,7 @@ import json
 import math
 import random
 import threading
-from enum import Enum
+from enum import Enum, IntEnum
 
 from agt import AlexaGadget
 
@@ -27,35 +27,75 @@ from ev3dev2.sensor.lego import InfraredSensor
 from ev3dev2.sensor.lego import UltrasonicSensor
 from ev3dev2.sensor.lego import TouchSensor
 from ev3dev2.sensor.lego import GyroSensor
+
+# orjson parses the directive bytes natively when it is installed on the brick
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    def _json_loads(data):
+        return json.loads(data.decode("utf-8"))
+
 # Set the logging level to INFO to see messages from AlexaGadget
 logging.basicConfig(level=logging.INFO, stream=sys.stdout, format='%(message)s')
 logging.getLogger().addHandler(logging.StreamHandler(sys.stderr))
 logger = logging.getLogger(__name__)
 
+# Set GRIPP3R_DEBUG=1 to log move commands and the gyro angle while turning
+_DEBUG = os.environ.get("GRIPP3R_DEBUG") == "1"
+if _DEBUG:
+    logger.setLevel(logging.DEBUG)
+
+
+def _open_sensor_value(sensor, mode):
+    """
+    Puts the sensor in the given mode and opens its value0 sysfs attribute for raw reads.
+    :param sensor: the ev3dev2 sensor
+    :param mode: the sensor mode the value is read in
+    :return: the open read-only file descriptor
+    """
+    sensor.mode = mode
+    return os.open(os.path.join(sensor._path, 'value0'), os.O_RDONLY)
+
+
+def _read_sensor_value(fd):
+    """
+    Reads an integer value from an open sysfs attribute without reopening it.
+    :param fd: the file descriptor returned by _open_sensor_value
+    """
+    return int(os.pread(fd, 16, 0))
+
 
 class Direction(Enum):
     """
-    The list of directional commands and their variations.
+    The directional commands and the set of their variations.
     These variations correspond to the skill slot values.
     """
-    FORWARD = ['forward', 'forwards', 'go forward']
-    BACKWARD = ['back', 'backward', 'backwards', 'go backward']
-    LEFT = ['left', 'go left']
-    RIGHT = ['right', 'go right']
-    STOP = ['stop', 'brake', 'halt']
+    FORWARD = frozenset({'forward', 'forwards', 'go forward'})
+    BACKWARD = frozenset({'back', 'backward', 'backwards', 'go backward'})
+    LEFT = frozenset({'left', 'go left'})
+    RIGHT = frozenset({'right', 'go right'})
+    STOP = frozenset({'stop', 'brake', 'halt'})
+
+
+# Map every direction variation to its Direction member for a single lookup per command
+_DIR_BY_WORD = {word: d for d in Direction for word in d.value}
+
+# Canonical words passed to _move by the maneuvers
+_FORWARD = 'forward'
+_STOP = 'stop'
 
 
 class Command(Enum):
     """
-    The list of preset commands and their invocation variation.
+    The preset commands and the set of their invocation variations.
     These variations correspond to the skill slot values.
     """
-    MOVE_CIRCLE = ['circle', 'move around']
-    MOVE_SQUARE = ['square']
-    SENTRY = ['guard', 'guard mode', 'sentry', 'sentry mode']
-    PATROL = ['patrol', 'patrol mode']
-    FIRE_ONE = ['cannon', '1 shot', 'one shot']
-    FIRE_ALL = ['all shots', 'all shot']
+    MOVE_CIRCLE = frozenset({'circle', 'move around'})
+    MOVE_SQUARE = frozenset({'square'})
+    SENTRY = frozenset({'guard', 'guard mode', 'sentry', 'sentry mode'})
+    PATROL = frozenset({'patrol', 'patrol mode'})
+    FIRE_ONE = frozenset({'cannon', '1 shot', 'one shot'})
+    FIRE_ALL = frozenset({'all shots', 'all shot'})
 
 
 class EventName(Enum):
@@ -67,11 +107,32 @@ class EventName(Enum):
     SPEECH = "Speech"
 
 
+class State(IntEnum):
+    """
+    The maneuver the gadget is currently performing, watched by the proximity thread
+    """
+    IDLE = 0
+    COMING = 1
+    TAKING = 2
+    BRINGING = 3
+    TURNING = 4
+
+
 class MindstormsGadget(AlexaGadget):
     """
     A Mindstorms gadget that can perform bi-directional interaction with an Alexa skill.
     """
 
+    # Fixed speeds used by the maneuvers, built once instead of on every motor call
+    _SP100 = SpeedPercent(100)
+    _SPn100 = SpeedPercent(-100)
+    _SP50 = SpeedPercent(50)
+    _SPn50 = SpeedPercent(-50)
+    _SP4 = SpeedPercent(4)
+    _SPn4 = SpeedPercent(-4)
+    _SP0 = SpeedPercent(0)
+    _SPn10 = SpeedPercent(-10)
+
     def __init__(self):
         """
         Performs Alexa Gadget initialization routines and ev3dev resource allocation.
@@ -86,10 +147,19 @@ class MindstormsGadget(AlexaGadget):
         self.ir = InfraredSensor()
         self.touch = TouchSensor()
         self.gyro = GyroSensor()
-        self.isComing = False
-        self.isTaking = False
-        self.isBringing = False
-        self.isTurning = False
+        self.state = State.IDLE
+        # Keep the sensor values open so the proximity thread skips the ev3dev2 property overhead
+        self._ir_fd = _open_sensor_value(self.ir, InfraredSensor.MODE_IR_PROX)
+        self._gyro_fd = _open_sensor_value(self.gyro, GyroSensor.MODE_GYRO_ANG)
+        self._touch_fd = _open_sensor_value(self.touch, TouchSensor.MODE_TOUCH)
+        self._led_presets = self._open_led_presets(("BLACK", "GREEN", "RED", "YELLOW"))
+        # Set while a maneuver needs the proximity thread, so it sleeps when idle
+        self._active_evt = threading.Event()
+        self._breach_handlers = {
+            State.COMING: self._on_come_breach,
+            State.TAKING: self._on_take_breach,
+            State.BRINGING: self._on_bring_breach,
+        }
         # Start threads
         threading.Thread(target=self._proximity_thread, daemon=True).start()
 
@@ -98,8 +168,7 @@ class MindstormsGadget(AlexaGadget):
         Gadget connected to the paired Echo device.
         :param device_addr: the address of the device we connected to
         """
-        self.leds.set_color("LEFT", "GREEN")
-        self.leds.set_color("RIGHT", "GREEN")
+        self._set_colors("GREEN")
         logger.info("{} connected to Echo device".format(self.friendly_name))
 
     def on_disconnected(self, device_addr):
@@ -107,8 +176,7 @@ class MindstormsGadget(AlexaGadget):
         Gadget disconnected from the paired Echo device.
         :param device_addr: the address of the device we disconnected from
         """
-        self.leds.set_color("LEFT", "BLACK")
-        self.leds.set_color("RIGHT", "BLACK")
+        self._set_colors("BLACK")
         logger.info("{} disconnected from Echo device".format(self.friendly_name))
 
     def on_custom_mindstorms_gadget_control(self, directive):
@@ -117,7 +185,7 @@ class MindstormsGadget(AlexaGadget):
         :param directive: the custom directive with the matching namespace and name
         """
         try:
-            payload = json.loads(directive.payload.decode("utf-8"))
+            payload = _json_loads(directive.payload)
             print("Control payload: {}".format(payload), file=sys.stderr)
             control_type = payload["type"]
             if control_type == "move":
@@ -138,43 +206,61 @@ class MindstormsGadget(AlexaGadget):
             print("Missing expected parameters: {}".format(directive), file=sys.stderr)
 
     def _come(self, duration=10, speed=50):
-        self.leds.set_color("LEFT", "GREEN", 1)
-        self.leds.set_color("RIGHT", "GREEN", 1)
-        self.isComing = True
-        self._move(Direction.FORWARD.value[0], duration, speed)
+        self._set_colors("GREEN")
+        self.state = State.COMING
+        self._active_evt.set()
+        self._move(_FORWARD, duration, speed)
 
     def _take(self, duration=20, speed=50):
-        self.grip.on_for_rotations(SpeedPercent(100), 1)
-        self.leds.set_color("LEFT", "GREEN", 1)
-        self.leds.set_color("RIGHT", "GREEN", 1)
-        self.gyro.reset()
-        self.gyro.mode = 'GYRO-RATE'
-        self.gyro.mode = 'GYRO-ANG'
-        self.isTurning = True
-        self.drive.on_for_seconds(SpeedPercent(100), SpeedPercent(-100), 1.3)
-        self.drive.on_for_seconds(SpeedPercent(4), SpeedPercent(-4), 40)
-        self.isTaking = True
-        self.drive.on_for_seconds(SpeedPercent(50), SpeedPercent(50), duration)
+        self.grip.on_for_rotations(self._SP100, 1)
+        self._set_colors("GREEN")
+        self._spin_180()
+        self.state = State.TAKING
+        self._active_evt.set()
+        self.drive.on_for_seconds(self._SP50, self._SP50, duration)
 
     def _bring(self, duration=20):
-        self.isTurning = True
-        self.gyro.mode = 'GYRO-RATE'
-        self.gyro.mode = 'GYRO-ANG'
-        self.drive.on_for_seconds(SpeedPercent(100), SpeedPercent(-100), 1.3)
-        self.drive.on_for_seconds(SpeedPercent(4), SpeedPercent(-4), 40)
-        self.drive.on_for_seconds(SpeedPercent(50), SpeedPercent(50), 1.5)
-        self.grip.on_for_rotations(SpeedPercent(100), 1)
-        self.isTurning = True
-        self.gyro.mode = 'GYRO-RATE'
-        self.gyro.mode = 'GYRO-ANG'
-        self.drive.on_for_seconds(SpeedPercent(100), SpeedPercent(-100), 1.3)
-        self.drive.on_for_seconds(SpeedPercent(4), SpeedPercent(-4), 40)
-        self.isBringing = True
-        self.now = time.time()
-        self.drive.on_for_seconds(SpeedPercent(50), SpeedPercent(50), duration)
-        self.leds.set_color("LEFT", "GREEN", 1)
-        self.leds.set_color("RIGHT", "GREEN", 1)
+        self._spin_180()
+        self.drive.on_for_seconds(self._SP50, self._SP50, 1.5)
+        self.grip.on_for_rotations(self._SP100, 1)
+        self._spin_180()
+        self.state = State.BRINGING
+        self._active_evt.set()
+        self.now = time.monotonic()
+        self.drive.on_for_seconds(self._SP50, self._SP50, duration)
+        self._set_colors("GREEN")
+
+
+    def _spin_180(self, block=True):
+        """
+        Spins the robot on the spot, the proximity thread stops it once the gyro reads 180 degrees.
+        :param block: if set, wait until the spin is stopped before returning
+        """
+        self._reset_gyro()
+        self.state = State.TURNING
+        self._active_evt.set()
+        self.drive.on_for_seconds(self._SP100, self._SPn100, 1.3)
+        self.drive.on_for_seconds(self._SP4, self._SPn4, 40, block=block)
 
+    def _close_grip(self):
+        """
+        Closes the grip continuously until the touch sensor is pressed.
+        """
+        touch_fd = self._touch_fd
+        if _read_sensor_value(touch_fd):
+            return
+        self.grip.on(self._SPn10, block=False)
+        while not _read_sensor_value(touch_fd):
+            time.sleep(0.02)
+        self.grip.off(brake=True)
+
+    def _reset_gyro(self):
+        """
+        Zeroes the gyro angle, switching through the rate mode since reset() alone is not reliable.
+        """
+        self.gyro.reset()
+        self.gyro.mode = GyroSensor.MODE_GYRO_RATE
+        self.gyro.mode = GyroSensor.MODE_GYRO_ANG
 
     def _move(self, direction, duration: int, speed: int, is_blocking=False):
         """
@@ -185,18 +271,20 @@ class MindstormsGadget(AlexaGadget):
         :param speed: the speed percentage as an integer
         :param is_blocking: if set, motor run until duration expired before accepting another command
         """
-        print("Move command: ({}, {}, {}, {})".format(direction, speed, duration, is_blocking), file=sys.stderr)
-        if direction in Direction.FORWARD.value:
+        if _DEBUG:
+            logger.debug("Move command: (%s, %s, %s, %s)", direction, speed, duration, is_blocking)
+        d = _DIR_BY_WORD.get(direction)
+        if d is Direction.FORWARD:
             self.drive.on_for_seconds(SpeedPercent(speed), SpeedPercent(speed), duration, block=is_blocking)
 
-        if direction in Direction.BACKWARD.value:
+        elif d is Direction.BACKWARD:
             self.drive.on_for_seconds(SpeedPercent(-speed), SpeedPercent(-speed), duration, block=is_blocking)
 
-        if direction in (Direction.RIGHT.value + Direction.LEFT.value):
-            self._turn(direction, speed)
+        elif d is Direction.RIGHT or d is Direction.LEFT:
+            self._turn(d, speed)
             self.drive.on_for_seconds(SpeedPercent(speed), SpeedPercent(speed), duration, block=is_blocking)
 
-        if direction in Direction.STOP.value:
+        elif d is Direction.STOP:
             self.drive.off()
             self.patrol_mode = False
 
@@ -204,14 +292,40 @@ class MindstormsGadget(AlexaGadget):
         """
         Turns based on the specified direction and speed.
         Calibrated for hard smooth surface.
-        :param direction: the turn direction
+        :param direction: the turn Direction member
         :param speed: the turn speed
         """
-        if direction in Direction.LEFT.value:
-            self.drive.on_for_seconds(SpeedPercent(0), SpeedPercent(speed), 2)
+        if direction is Direction.LEFT:
+            self.drive.on_for_seconds(self._SP0, SpeedPercent(speed), 2)
 
-        if direction in Direction.RIGHT.value:
-            self.drive.on_for_seconds(SpeedPercent(speed), SpeedPercent(0), 2)
+        elif direction is Direction.RIGHT:
+            self.drive.on_for_seconds(SpeedPercent(speed), self._SP0, 2)
+
+    def _open_led_presets(self, colors):
+        """
+        Opens the brightness attribute of every LED once and precomputes the values for each color.
+        :param colors: the LED color names to precompute
+        :return: a dict mapping each color to a list of (file descriptor, brightness bytes)
+        """
+        fds = {}
+        presets = {}
+        for color in colors:
+            writes = []
+            for group in ("LEFT", "RIGHT"):
+                for led, value in zip(self.leds.led_groups[group], self.leds.led_colors[color]):
+                    if led._path not in fds:
+                        fds[led._path] = os.open(os.path.join(led._path, 'brightness'), os.O_WRONLY)
+                    writes.append((fds[led._path], str(int(value * led.max_brightness)).encode()))
+            presets[color] = writes
+        return presets
+
+    def _set_colors(self, color):
+        """
+        Sets both LED groups to the same color by writing the precomputed brightness values.
+        :param color: one of the colors opened by _open_led_presets
+        """
+        for fd, value in self._led_presets[color]:
+            os.pwrite(fd, value, 0)
 
     def _send_event(self, name: EventName, payload):
         """
@@ -227,68 +341,83 @@ class MindstormsGadget(AlexaGadget):
         If the minimum distance is breached, send a custom event to trigger action on
         the Alexa skill.
         """
+        # Bind everything the loop touches to locals once, the loop runs for the robot's entire uptime
+        fabs = math.fabs
+        sleep = time.sleep
+        read_value = _read_sensor_value
+        ir_fd = self._ir_fd
+        gyro_fd = self._gyro_fd
+        set_colors = self._set_colors
+        active_evt = self._active_evt
+        breach_handlers = self._breach_handlers
         while True:
-            distance = self.ir.proximity
-            angle = self.gyro.angle
+            active_evt.wait()
+            distance = read_value(ir_fd)
+            angle = read_value(gyro_fd)
             #print("Proximity: {}".format(distance), file=sys.stderr)
-            if self.isTurning == True:
-                print("angle: {}".format(angle), file=sys.stderr)
-                self.leds.set_color("LEFT", "YELLOW", 1)
-                self.leds.set_color("RIGHT", "YELLOW", 1)
-                if abs(angle) >= 179 or abs(angle) <= -181:
-                    self.isTurning = False
-                    self._move(Direction.STOP.value[0], 0, 0,)
-                    self.gyro.reset()
-                    self.gyro.mode = 'GYRO-RATE'
-                    self.gyro.mode = 'GYRO-ANG'
-                    self.leds.set_color("LEFT", "GREEN", 1)
-                    self.leds.set_color("RIGHT", "GREEN", 1)
-
-            if distance <= 55:
-                """
-                When the bot is coming, it will stop and open up it's arm
-                """
-
-                if self.isComing == True:
-                    self.isComing = False
-                    print("Proximity breached, stopping")
-                    self._move(Direction.STOP.value[0], 0, 0,)
-                    self.leds.set_color("LEFT", "RED", 1)
-                    self.leds.set_color("RIGHT", "RED", 1)
-                    while not self.touch.is_pressed:
-                        self.grip.on_for_degrees(SpeedPercent(10), -90)                        
-                    print("Lowered the grip")
-                elif self.isTaking ==True:
-                    self.isTaking = False
-                    print("Proximity breached, stopping")
-                    self._move(Direction.STOP.value[0], 0, 0,)
-                    self.leds.set_color("LEFT", "RED", 1)
-                    self.leds.set_color("RIGHT", "RED", 1)
-                    while not self.touch.is_pressed:
-                        self.grip.on_for_degrees(SpeedPercent(10), -90)                        
-                    print("Dropping Item")
-                    self.drive.on_for_seconds(SpeedPercent(-50), SpeedPercent(-50), 1)
-                    self.gyro.reset()
-                    self.isTurning = True
-                    self.gyro.mode = 'GYRO-RATE'
-                    self.gyro.mode = 'GYRO-ANG'
-                    self.drive.on_for_seconds(SpeedPercent(100), SpeedPercent(-100), 1.3)
-                    self.drive.on_for_seconds(SpeedPercent(4), SpeedPercent(-4), 40, block=False)
-                    self.leds.set_color("LEFT", "GREEN", 1)
-                    self.leds.set_color("RIGHT", "GREEN", 1)
-                elif self.isBringing ==True:
-                    self.isBringing = False
-                    print("Proximity breached, stopping")
-                    self._move(Direction.STOP.value[0], 0, 0)
-                    self.later = time.time()
-                    self.leds.set_color("LEFT", "RED", 1)
-                    self.leds.set_color("RIGHT", "RED", 1)
-                    while not self.touch.is_pressed:
-                        self.grip.on_for_degrees(SpeedPercent(10), -90)             
-                    print("Dropping Item")
-                    difference = int(self.later - self.now)
-                    self.drive.on_for_seconds(SpeedPercent(-50), SpeedPercent(-50), difference - 0.5)
-            time.sleep(0.2)
+            state = self.state
+            if state is State.TURNING:
+                if _DEBUG:
+                    logger.debug("angle: %s", angle)
+                set_colors("YELLOW")
+                if fabs(angle) >= 179.0:
+                    self.state = State.IDLE
+                    self._move(_STOP, 0, 0)
+                    self._reset_gyro()
+                    set_colors("GREEN")
+
+            elif distance <= 55:
+                handler = breach_handlers.get(state)
+                if handler:
+                    handler()
+
+            if self.state is State.IDLE:
+                active_evt.clear()
+                # A command may have changed the state between the check and the clear
+                if self.state is not State.IDLE:
+                    active_evt.set()
+            sleep(0.2)
+
+    def _on_come_breach(self):
+        """
+        When the bot is coming, it will stop and open up it's arm
+        """
+        self.state = State.IDLE
+        print("Proximity breached, stopping")
+        self._move(_STOP, 0, 0)
+        self._set_colors("RED")
+        self._close_grip()
+        print("Lowered the grip")
+
+    def _on_take_breach(self):
+        """
+        When the bot is taking an item, it will drop it, back off and turn around
+        """
+        self.state = State.IDLE
+        print("Proximity breached, stopping")
+        self._move(_STOP, 0, 0)
+        self._set_colors("RED")
+        self._close_grip()
+        print("Dropping Item")
+        self.drive.on_for_seconds(self._SPn50, self._SPn50, 1)
+        self._spin_180(block=False)
+        self._set_colors("GREEN")
+
+    def _on_bring_breach(self):
+        """
+        When the bot is bringing an item, it will drop it and back up the distance it drove
+        """
+        self.state = State.IDLE
+        print("Proximity breached, stopping")
+        self._move(_STOP, 0, 0)
+        self.later = time.monotonic()
+        self._set_colors("RED")
+        self._close_grip()
+        print("Dropping Item")
+        # on_for_seconds rejects negative durations, which a breach right after setting off would give
+        difference = max(0.0, self.later - self.now - 0.5)
+        if difference > 0:
+            self.drive.on_for_seconds(self._SPn50, self._SPn50, difference)
 
 
 if __name__ == '__main__':
@@ -297,18 +426,15 @@ if __name__ == '__main__':
 
     # Set LCD font and turn off blinking LEDs
     os.system('setfont Lat7-Terminus12x6')
-    gadget.leds.set_color("LEFT", "BLACK")
-    gadget.leds.set_color("RIGHT", "BLACK")
+    gadget._set_colors("BLACK")
 
     # Startup sequence
     gadget.sound.play_song((('C4', 'e'), ('D4', 'e'), ('E5', 'q')))
-    gadget.leds.set_color("LEFT", "GREEN")
-    gadget.leds.set_color("RIGHT", "GREEN")
+    gadget._set_colors("GREEN")
 
     # Gadget main entry point
     gadget.main()
 
     # Shutdown sequence
     gadget.sound.play_song((('E5', 'e'), ('C4', 'e')))
-    gadget.leds.set_color("LEFT", "BLACK")
-    gadget.leds.set_color("RIGHT", "BLACK")
+    gadget._set_colors("BLACK")